@@ -1,10 +1,18 @@
 import discord
+import asyncio
+import heapq
 import json
 import math
 import random
 import os
-from functools import partial
-from PIL import Image, ImageDraw, ImageFont
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime
+from functools import lru_cache, partial
+from PIL import Image, ImageDraw, ImageFont, features
 from io import BytesIO
 from discord import app_commands
 from discord.ui import Button, View
@@ -16,7 +24,7 @@ from graphviz import Digraph
 #helpers
 #################################################################################
 DATA_FILE = "server_leaderboard.json"
-ACTIVE_CHALLENGES_FILE = "active_challenges.json"
+ACTIVE_CHALLENGES_DIR = "active_challenges"
 
 # -----------------------------
 # Helper functions for ELO and storage
@@ -48,14 +56,863 @@ def update_elo(guild_id, winner_id, loser_id, data, k=32):
     expected_winner = 1 / (1 + math.pow(10, (loser["elo"] - winner["elo"]) / 400))
     expected_loser = 1 - expected_winner
 
-    winner["elo"] += round(k * (1 - expected_winner))
+    gained = round(k * (1 - expected_winner))
+    winner["elo"] += gained
     loser["elo"] += round(k * (0 - expected_loser))
 
     winner["wins"] += 1
     loser["losses"] += 1
 
+    # Streaks: positive = consecutive wins, negative = consecutive losses
+    winner["streak"] = max(winner.get("streak", 0), 0) + 1
+    loser["streak"] = min(loser.get("streak", 0), 0) - 1
+    winner["best_streak"] = max(winner.get("best_streak", 0), winner["streak"])
+
     data[str(guild_id)][str(winner_id)] = winner
     data[str(guild_id)][str(loser_id)] = loser
+    return gained
+
+
+# -----------------------------
+# Append-only record logs (for state that changes a little on every match)
+# -----------------------------
+LOG_COMPACT_MIN = 1000  # lines before a log is worth compacting
+
+class RecordLog:
+    # One file per guild with a [key, value] line per change. The last line for
+    # a key wins and a None value deletes it. Rewritten once most lines are stale,
+    # so each change costs O(1) amortized instead of re-saving everything.
+    def __init__(self, directory):
+        self.directory = directory
+        self.lines = {}  # guild id -> lines in the file
+
+    def _path(self, guild_id):
+        return os.path.join(self.directory, f"{guild_id}.jsonl")
+
+    def load(self):
+        guilds = {}
+        if not os.path.isdir(self.directory):
+            return guilds
+        for name in os.listdir(self.directory):
+            if not name.endswith(".jsonl"):
+                continue
+            guild_id = name[:-len(".jsonl")]
+            records = {}
+            lines = 0
+            with open(self._path(guild_id), "r") as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        continue  # partial line from an interrupted write
+                    lines += 1
+                    if value is None:
+                        records.pop(key, None)
+                    else:
+                        records[key] = value
+            guilds[guild_id] = records
+            self.lines[guild_id] = lines
+        return guilds
+
+    def append(self, guild_id, changes, live_count, all_records):
+        # changes: [(key, value or None), ...]; all_records (key, value pairs) is
+        # only iterated when the log gets compacted
+        guild_id = str(guild_id)
+        path = self._path(guild_id)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, "a") as f:
+            for key, value in changes:
+                f.write(json.dumps([key, value]) + "\n")
+        self.lines[guild_id] = self.lines.get(guild_id, 0) + len(changes)
+
+        if self.lines[guild_id] > LOG_COMPACT_MIN and self.lines[guild_id] > 2 * live_count:
+            with open(path + ".tmp", "w") as f:
+                for key, value in all_records:
+                    f.write(json.dumps([key, value]) + "\n")
+            os.replace(path + ".tmp", path)
+            self.lines[guild_id] = live_count
+
+
+# -----------------------------
+# Rating history (one append-only binary file per player)
+# -----------------------------
+HISTORY_DIR = "rating_history"
+HISTORY_MAX_POINTS = 512     # per user, before older points get downsampled
+HISTORY_RECENT_POINTS = 128  # newest points are always kept at full resolution
+HISTORY_BUCKETS = [86400, 7 * 86400, 30 * 86400]  # older points: one per day, week, then month
+POINT_SIZE = 16              # int64 timestamp + int64 elo
+
+class RatingHistory:
+    def __init__(self, directory):
+        self.directory = directory
+        self.compacted = {}  # path -> points left after the last downsample
+
+    def _path(self, guild_id, user_id):
+        return os.path.join(self.directory, str(guild_id), f"{user_id}.bin")
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return array("q"), array("q")
+        points = array("q")
+        points.frombytes(data[:len(data) - len(data) % POINT_SIZE])  # drop a half-written tail
+        return points[0::2], points[1::2]
+
+    def _downsample(self, timestamps, elos):
+        # Keep the last point of each day (then week, then month) older than the
+        # recent window. Re-running with the same bucket keeps the same points,
+        # so old history only ever gets coarser, never emptied.
+        split = len(timestamps) - HISTORY_RECENT_POINTS
+        for bucket in HISTORY_BUCKETS:
+            kept = [i for i in range(split) if i == split - 1 or timestamps[i] // bucket != timestamps[i + 1] // bucket]
+            if len(kept) + HISTORY_RECENT_POINTS <= HISTORY_MAX_POINTS:
+                break
+        kept_ts = array("q", (timestamps[i] for i in kept)) + timestamps[split:]
+        kept_elos = array("q", (elos[i] for i in kept)) + elos[split:]
+        return kept_ts, kept_elos
+
+    def _compact(self, path):
+        # Bounded by one player's file (a few KB), so fine to do inline
+        timestamps, elos = self._downsample(*self._read(path))
+        points = array("q", bytes(POINT_SIZE * len(timestamps)))
+        points[0::2] = timestamps
+        points[1::2] = elos
+        with open(path + ".tmp", "wb") as f:
+            points.tofile(f)
+        os.replace(path + ".tmp", path)
+        self.compacted[path] = len(timestamps)
+
+    def append(self, guild_id, points, ts=None):
+        # points: [(user_id, elo_after), ...] sharing one timestamp
+        ts = int(ts if ts is not None else time.time())
+        os.makedirs(os.path.join(self.directory, str(guild_id)), exist_ok=True)
+        for user_id, elo in points:
+            path = self._path(guild_id, user_id)
+            with open(path, "ab") as f:
+                array("q", [ts, elo]).tofile(f)
+                count = f.tell() // POINT_SIZE
+            if count > HISTORY_MAX_POINTS and count > self.compacted.get(path, 0) + HISTORY_RECENT_POINTS:
+                self._compact(path)
+
+    def get(self, guild_id, user_id):
+        # Reads one player's file; call it from a worker thread
+        timestamps, elos = self._read(self._path(guild_id, user_id))
+        return timestamps.tolist(), elos.tolist()
+
+
+def render_rating_chart(name, timestamps, elos, stats):
+    width, height = 800, 400
+    left, right, top, bottom = 70, 30, 70, 50
+    image = Image.new("RGBA", (width, height), (30, 30, 30, 255))
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.truetype("arial.ttf", 24)
+    small_font = ImageFont.truetype("arial.ttf", 16)
+
+    streak = stats.get("streak", 0)
+    streak_text = f"W{streak}" if streak > 0 else f"L{-streak}" if streak < 0 else "-"
+    draw.text((left, 15), f"{name}  {stats['elo']} ({stats['wins']}/{stats['losses']})", font=font, fill="white")
+    header = f"Streak: {streak_text}   Best win streak: {stats.get('best_streak', 0)}"
+    draw.text((int(width - right - draw.textlength(header, font=small_font)), 22), header, font=small_font, fill="white")
+
+    low, high = min(elos), max(elos)
+    if low == high:
+        low, high = low - 10, high + 10
+    start, end = timestamps[0], timestamps[-1]
+    span = max(end - start, 1)
+
+    def to_xy(ts, elo):
+        x = left + (ts - start) / span * (width - left - right)
+        y = top + (high - elo) / (high - low) * (height - top - bottom)
+        return (int(x), int(y))
+
+    # Axes and labels
+    draw.line([(left, top), (left, height - bottom), (width - right, height - bottom)], fill=(120, 120, 120), width=1)
+    draw.text((10, top - 8), str(high), font=small_font, fill="white")
+    draw.text((10, height - bottom - 8), str(low), font=small_font, fill="white")
+    draw.text((left, height - bottom + 10), datetime.fromtimestamp(start).strftime("%Y-%m-%d"), font=small_font, fill="white")
+    end_label = datetime.fromtimestamp(end).strftime("%Y-%m-%d")
+    draw.text((int(width - right - draw.textlength(end_label, font=small_font)), height - bottom + 10), end_label, font=small_font, fill="white")
+
+    points = [to_xy(ts, elo) for ts, elo in zip(timestamps, elos)]
+    if len(points) > 1:
+        draw.line(points, fill=(255, 215, 0), width=3)
+    else:
+        x, y = points[0]
+        draw.ellipse((x - 4, y - 4, x + 4, y + 4), fill=(255, 215, 0))
+
+    return image
+
+
+# -----------------------------
+# Image encoding (shared by every image upload)
+# -----------------------------
+DEFAULT_UPLOAD_LIMIT = 10 * 1024 * 1024  # used when there's no guild to ask
+ENCODE_LATENCY_BUDGET_MS = 200
+MIN_IMAGE_WIDTH = 200                    # never downscale below this
+WEBP_SUPPORTED = features.check("webp")
+
+# Rough encode cost in ms per megapixel for each effort level, highest first
+PNG_LEVEL_COST = [(9, 400), (6, 150), (3, 60), (1, 30)]
+WEBP_METHOD_COST = [(6, 1500), (4, 600), (2, 250), (0, 100)]
+
+ENCODE_METRICS_LOG_INTERVAL = 3600     # seconds between metrics log lines
+ENCODE_BASELINE_SAMPLE = 20            # re-measure the default PNG for 1 in N rendered images
+
+# source -> {"images", "bytes_in", "bytes_out", "bytes_saved", "encode_ms"}, where
+# bytes_in is what the upload used to cost: a default PNG or the Graphviz output
+encode_metrics = {}
+# source -> [sampled default PNG bytes, encoded bytes of the same images], used
+# to estimate the default PNG size of rendered images that aren't sampled
+encode_baselines = {}
+encode_metrics_lock = threading.Lock()  # updated from worker threads
+
+def pick_effort(costs, pixels, latency_budget_ms):
+    megapixels = pixels / 1_000_000
+    for level, cost in costs:
+        if cost * megapixels <= latency_budget_ms:
+            return level
+    return costs[-1][0]
+
+def record_encode_metrics(source, bytes_in, bytes_out, encode_ms):
+    with encode_metrics_lock:
+        metrics = encode_metrics.setdefault(source, {"images": 0, "bytes_in": 0, "bytes_out": 0, "bytes_saved": 0, "encode_ms": 0.0})
+        metrics["images"] += 1
+        metrics["bytes_in"] += bytes_in
+        metrics["bytes_out"] += bytes_out
+        metrics["bytes_saved"] += bytes_in - bytes_out
+        metrics["encode_ms"] += encode_ms
+
+def sample_rendered_encode(image, source, bytes_out, encode_ms):
+    # Baseline for rendered images: the plain image.save(..., "PNG") uploads used before
+    baseline = BytesIO()
+    image.save(baseline, "PNG")
+    with encode_metrics_lock:
+        sampled = encode_baselines.setdefault(source, [0, 0])
+        sampled[0] += baseline.tell()
+        sampled[1] += bytes_out
+    record_encode_metrics(source, baseline.tell(), bytes_out, encode_ms)
+
+def record_rendered_encode(image, source, bytes_out, encode_ms):
+    # Only a sample pays for a second encode; the rest are estimated from the
+    # sampled size ratio
+    with encode_metrics_lock:
+        sampled = encode_baselines.get(source)
+    if sampled is None or random.random() < 1 / ENCODE_BASELINE_SAMPLE:
+        future = asyncio.get_running_loop().run_in_executor(None, sample_rendered_encode, image, source, bytes_out, encode_ms)
+        future.add_done_callback(log_sample_error)
+    else:
+        record_encode_metrics(source, bytes_out * sampled[0] // sampled[1], bytes_out, encode_ms)
+
+def log_sample_error(future):
+    if not future.cancelled() and future.exception():
+        print(f"Failed to measure encode baseline: {future.exception()!r}")
+
+async def log_encode_metrics():
+    with encode_metrics_lock:
+        totals = {source: dict(metrics) for source, metrics in encode_metrics.items()}
+    for source, metrics in totals.items():
+        print(f"Image encoding ({source}): {metrics['images']} images, {metrics['bytes_saved']} bytes saved, "
+              f"{metrics['encode_ms'] / metrics['images']:.0f} ms average")
+    client.expiry.schedule("encode_metrics", time.time() + ENCODE_METRICS_LOG_INTERVAL, log_encode_metrics)
+
+def encode_image(image, max_bytes=DEFAULT_UPLOAD_LIMIT, palette=False, latency_budget_ms=ENCODE_LATENCY_BUDGET_MS):
+    # image is a PIL image or already-encoded bytes (e.g. Graphviz output).
+    # palette=True suits flat images like the bracket; photos (avatars) go to
+    # lossless WebP. Returns (BytesIO, file extension, size, encode ms).
+    start = time.perf_counter()
+    original = None
+    if isinstance(image, bytes):
+        original = image
+        image = Image.open(BytesIO(image))
+        image.load()
+        original_format = image.format.lower()
+
+    if palette:
+        image = image.convert("RGBA").quantize(colors=256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+
+    while True:
+        pixels = image.width * image.height
+        output = BytesIO()
+        if palette or not WEBP_SUPPORTED:
+            image.save(output, "PNG", compress_level=pick_effort(PNG_LEVEL_COST, pixels, latency_budget_ms))
+            extension = "png"
+        else:
+            image.save(output, "WEBP", lossless=True, method=pick_effort(WEBP_METHOD_COST, pixels, latency_budget_ms))
+            extension = "webp"
+
+        size = output.tell()
+        if size <= max_bytes or image.width <= MIN_IMAGE_WIDTH:
+            break
+        # Bytes scale roughly with area, so shrink both sides by sqrt of the overshoot
+        scale = max(math.sqrt(max_bytes / size) * 0.9, MIN_IMAGE_WIDTH / image.width)
+        image = image.resize((int(image.width * scale), max(int(image.height * scale), 1)),
+                             Image.Resampling.NEAREST if palette else Image.Resampling.LANCZOS)
+
+    # Re-encoding didn't help and the original already fits: send it as is
+    if original is not None and len(original) <= min(size, max_bytes):
+        output, size, extension = BytesIO(original), len(original), original_format
+
+    output.seek(0)
+    return output, extension, size, (time.perf_counter() - start) * 1000
+
+async def encode_upload(image, source, guild=None, **kwargs):
+    max_bytes = guild.filesize_limit if guild else DEFAULT_UPLOAD_LIMIT
+    output, extension, size, encode_ms = await asyncio.to_thread(encode_image, image, max_bytes, **kwargs)
+    if isinstance(image, bytes):
+        record_encode_metrics(source, len(image), size, encode_ms)
+    else:
+        record_rendered_encode(image, source, size, encode_ms)
+    return discord.File(fp=output, filename=f"{source}.{extension}")
+
+
+# -----------------------------
+# Expiry scheduler (one heap + one task for all pending challenges/matches)
+# -----------------------------
+CHALLENGE_ACCEPT_TIMEOUT = 600   # 10 min to accept a challenge
+WINNER_SELECT_TIMEOUT = 1500     # 25 min to pick the winner
+TOURNAMENT_MATCH_TIMEOUT = 3600  # 1 hour per tournament match
+
+class ExpiryScheduler:
+    def __init__(self):
+        self.heap = []        # (deadline, seq, key), may hold stale entries
+        self.pending = {}     # key -> (deadline, callback)
+        self.seq = 0
+        self.wakeup = None
+        self.task = None
+        self.running = set()  # fired callbacks, kept referenced until done
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def schedule(self, key, deadline, callback):
+        # Rescheduling a key just leaves the old heap entry to be skipped
+        self.pending[key] = (deadline, callback)
+        self.seq += 1
+        heapq.heappush(self.heap, (deadline, self.seq, key))
+        if len(self.heap) > 2 * len(self.pending) + 64:
+            self.heap = [(d, i, k) for d, i, k in self.heap if self.pending.get(k, (None,))[0] == d]
+            heapq.heapify(self.heap)
+        if self.wakeup and self.heap[0][2] == key:
+            self.wakeup.set()
+
+    def cancel(self, key):
+        self.pending.pop(key, None)
+
+    async def _fire(self, key, callback):
+        try:
+            await callback()
+        except Exception as e:
+            print(f"Error expiring {key}: {e}")
+
+    async def run(self):
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self.heap)
+                entry = self.pending.get(key)
+                if entry is None or entry[0] != deadline:
+                    continue  # cancelled or rescheduled
+                del self.pending[key]
+                task = asyncio.create_task(self._fire(key, entry[1]))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+# -----------------------------
+# Global leaderboard (opt-in, updated incrementally on every result)
+# -----------------------------
+GLOBAL_OPT_IN_FILE = "global_opt_in.json"
+
+class ScoreIndex:
+    # Fenwick tree over integer scores: rank and top-N in O(log n)
+    def __init__(self, size=4096):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        self.buckets = {}  # score -> set of user ids
+        self.scores = {}   # user id -> score
+
+    def _add(self, score, delta):
+        i = score + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def _count_at_most(self, score):
+        total = 0
+        i = min(score + 1, self.size)
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def _kth(self, k):
+        # Smallest score with at least k users at or below it
+        pos = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            if pos + step <= self.size and self.tree[pos + step] < k:
+                pos += step
+                k -= self.tree[pos]
+            step >>= 1
+        return pos
+
+    def _grow(self, score):
+        while score >= self.size:
+            self.size *= 2
+        self.tree = [0] * (self.size + 1)
+        for bucket_score, users in self.buckets.items():
+            self._add(bucket_score, len(users))
+
+    def remove(self, user_id):
+        score = self.scores.pop(user_id, None)
+        if score is None:
+            return
+        bucket = self.buckets[score]
+        bucket.discard(user_id)
+        if not bucket:
+            del self.buckets[score]
+        self._add(score, -1)
+
+    def set(self, user_id, score):
+        score = max(int(score), 0)
+        if self.scores.get(user_id) == score:
+            return
+        self.remove(user_id)
+        if score >= self.size:
+            self._grow(score)
+        self.scores[user_id] = score
+        self.buckets.setdefault(score, set()).add(user_id)
+        self._add(score, 1)
+
+    def rank(self, user_id):
+        # Tied players share a rank
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        return len(self.scores) - self._count_at_most(score) + 1
+
+    def next_below(self, score=None):
+        # Highest score held by anyone below score (or overall), None if there is none
+        below = len(self.scores) if score is None else self._count_at_most(score - 1)
+        return self._kth(below) if below else None
+
+    def top(self, n):
+        result = []
+        below = len(self.scores)
+        while below and len(result) < n:
+            score = self._kth(below)
+            for user_id in heapq.nsmallest(n - len(result), self.buckets[score]):
+                result.append((user_id, score))
+            below -= len(self.buckets[score])
+        return result
+
+
+class GlobalLeaderboard:
+    # Everything runs on the event loop, so updates from different guilds
+    # never race and no lock is needed
+    def __init__(self):
+        self.players = {}  # user id -> {guild id: stats dict from leaderboard_data}
+        self.indexes = {"elo": ScoreIndex(), "wins": ScoreIndex()}
+
+    def totals(self, user_id):
+        guilds = self.players[user_id].values()
+        return (
+            max(stats["elo"] for stats in guilds),
+            sum(stats["wins"] for stats in guilds),
+            sum(stats["losses"] for stats in guilds),
+        )
+
+    def _reindex(self, user_id):
+        if not self.players.get(user_id):
+            self.players.pop(user_id, None)
+            for index in self.indexes.values():
+                index.remove(user_id)
+            return
+        best, wins, _ = self.totals(user_id)
+        self.indexes["elo"].set(user_id, best)
+        self.indexes["wins"].set(user_id, wins)
+
+    def update(self, guild_id, user_id, stats):
+        user_id = str(user_id)
+        self.players.setdefault(user_id, {})[str(guild_id)] = stats
+        self._reindex(user_id)
+
+    def add_guild(self, guild_id, guild_data):
+        for user_id, stats in guild_data.items():
+            self.update(guild_id, user_id, stats)
+
+    def remove_guild(self, guild_id, guild_data):
+        for user_id in guild_data:
+            self.players.get(user_id, {}).pop(str(guild_id), None)
+            self._reindex(user_id)
+
+
+# -----------------------------
+# Server standings (per-guild elo order, kept current on every result)
+# -----------------------------
+class Standings:
+    def __init__(self, data):
+        self.data = data   # leaderboard_data
+        self.indexes = {}  # guild id -> ScoreIndex of elo
+        # guild id -> one state per running walk: "old" maps a user id to their
+        # (elo, wins, losses) before their first change since the walk started
+        # (None if they joined since), "at" groups those by score and "scores"
+        # is a max-heap (negated) of the scores in "at"
+        self.walks = {}
+        for guild_id, guild_data in data.items():
+            index = self.indexes[guild_id] = ScoreIndex()
+            for user_id, stats in guild_data.items():
+                index.set(user_id, stats["elo"])
+
+    def before_update(self, guild_id, user_ids):
+        # Copy-on-write for running walks, so each one sees the standings as
+        # they were when it started
+        guild_data = self.data.get(str(guild_id), {})
+        for walk in self.walks.get(str(guild_id), ()):
+            for user_id in user_ids:
+                if user_id in walk["old"]:
+                    continue
+                stats = guild_data.get(user_id)
+                walk["old"][user_id] = (stats["elo"], stats["wins"], stats["losses"]) if stats else None
+                if stats:
+                    score = max(int(stats["elo"]), 0)
+                    if score not in walk["at"]:
+                        heapq.heappush(walk["scores"], -score)
+                    walk["at"].setdefault(score, []).append(user_id)
+
+    def update(self, guild_id, user_ids):
+        guild_data = self.data[str(guild_id)]
+        index = self.indexes.setdefault(str(guild_id), ScoreIndex())
+        for user_id in user_ids:
+            index.set(user_id, guild_data[user_id]["elo"])
+
+    def reset(self, guild_id):
+        # Running walks keep the old index and table, which no longer change
+        self.indexes[str(guild_id)] = ScoreIndex()
+        self.walks.pop(str(guild_id), None)
+
+    def walk(self, guild_id, batch_size):
+        # Yields [(user id, elo, wins, losses), ...] batches in rank order, one
+        # score bucket at a time from the top, so nothing is sorted or copied
+        # up front. Runs on the event loop between batches; close() it when done
+        guild_id = str(guild_id)
+        index = self.indexes.get(guild_id, ScoreIndex())
+        guild_data = self.data.get(guild_id, {})
+        walk = {"old": {}, "at": {}, "scores": []}
+        walks = self.walks.setdefault(guild_id, [])
+        walks.append(walk)
+        old, at, scores = walk["old"], walk["at"], walk["scores"]
+        try:
+            batch = []
+            score = None
+            while True:
+                # Players changed since the walk started are listed at their old
+                # score, which may no longer be in the index. Old scores at or
+                # above the current one were already listed live
+                while scores and score is not None and -scores[0] >= score:
+                    at.pop(-heapq.heappop(scores), None)
+                live = index.next_below(score)
+                if scores and (live is None or -scores[0] > live):
+                    score = -scores[0]
+                else:
+                    score = live
+                if score is None:
+                    break
+                rows = [(user_id, guild_data[user_id]["elo"], guild_data[user_id]["wins"], guild_data[user_id]["losses"])
+                        for user_id in index.buckets.get(score, ()) if user_id not in old]
+                rows += [(user_id,) + old[user_id] for user_id in at.get(score, ())]
+                batch += sorted(rows)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            walks.remove(walk)
+
+
+# -----------------------------
+# Head-to-head records (only pairs that have actually played are stored)
+# -----------------------------
+HEAD_TO_HEAD_DIR = "head_to_head"
+
+class HeadToHead:
+    def __init__(self, directory):
+        # guild id -> {"<low id>:<high id>": {"wins": .., "losses": .., "last_played": ..}}
+        # wins/losses are from the lower id's side; each changed pair is appended
+        # to the guild's log
+        self.log = RecordLog(directory)
+        self.data = self.log.load()
+        self.opponents = {}  # guild id -> {user id: set of opponent ids}, rebuilt on load
+        for guild_id, pairs in self.data.items():
+            for key in pairs:
+                low, high = key.split(":")
+                self._link(guild_id, low, high)
+
+    def _link(self, guild_id, low, high):
+        opponents = self.opponents.setdefault(guild_id, {})
+        opponents.setdefault(low, set()).add(high)
+        opponents.setdefault(high, set()).add(low)
+
+    @staticmethod
+    def pair_key(user_a, user_b):
+        low, high = sorted((int(user_a), int(user_b)))
+        return f"{low}:{high}", str(low)
+
+    def record(self, guild_id, winner_id, loser_id, ts=None):
+        guild_id = str(guild_id)
+        key, low = self.pair_key(winner_id, loser_id)
+        pairs = self.data.setdefault(guild_id, {})
+        if key not in pairs:
+            pairs[key] = {"wins": 0, "losses": 0, "last_played": 0}
+            self._link(guild_id, *key.split(":"))
+        pair = pairs[key]
+        if str(winner_id) == low:
+            pair["wins"] += 1
+        else:
+            pair["losses"] += 1
+        pair["last_played"] = int(ts if ts is not None else time.time())
+        self.log.append(guild_id, [(key, pair)], len(pairs), pairs.items())
+
+    def get(self, guild_id, user_a, user_b):
+        # (wins of user_a, wins of user_b, last played) or None if they never met
+        key, low = self.pair_key(user_a, user_b)
+        pair = self.data.get(str(guild_id), {}).get(key)
+        if pair is None:
+            return None
+        if str(user_a) == low:
+            return pair["wins"], pair["losses"], pair["last_played"]
+        return pair["losses"], pair["wins"], pair["last_played"]
+
+    def rivals(self, guild_id, user_id, n=5):
+        # Most-played opponents: [(opponent id, wins, losses, last played), ...]
+        records = [
+            (opponent,) + self.get(guild_id, user_id, opponent)
+            for opponent in self.opponents.get(str(guild_id), {}).get(str(user_id), ())
+        ]
+        return heapq.nlargest(n, records, key=lambda r: (r[1] + r[2], r[3]))
+
+
+# -----------------------------
+# Win-trading detection (running per-pair / per-player stats, O(1) per result)
+# -----------------------------
+INTEGRITY_DIR = "match_integrity"
+SUSPICION_MIN_GAMES = 10      # pair games before a pair can be flagged
+SUSPICION_REPEAT_SHARE = 0.5  # share of either player's games spent on this pair
+SUSPICION_ALTERNATION = 0.8   # share of pair results that flipped the previous winner
+SUSPICION_NET_TRANSFER = 150  # elo moved one way within the pair
+
+class IntegrityMonitor:
+    def __init__(self, directory):
+        # guild id -> {"pairs": {pair key: stats}, "games": {user id: games},
+        #              "flagged": {pair key: flag}, "alert_channel": channel id}
+        # The log stores one flat record per entry ("pair:<key>", "games:<user id>",
+        # "flag:<key>", "alert_channel"), so a result only appends what it changed
+        self.log = RecordLog(directory)
+        self.data = {}
+        for guild_id, records in self.log.load().items():
+            guild = self.guild(guild_id)
+            for record_key, value in records.items():
+                if record_key == "alert_channel":
+                    guild["alert_channel"] = value
+                    continue
+                section, key = record_key.split(":", 1)
+                guild[{"pair": "pairs", "games": "games", "flag": "flagged"}[section]][key] = value
+
+    def guild(self, guild_id):
+        return self.data.setdefault(str(guild_id), {"pairs": {}, "games": {}, "flagged": {}, "alert_channel": None})
+
+    def _records(self, guild):
+        # Every live record of a guild, only walked when its log is compacted
+        for key, pair in guild["pairs"].items():
+            yield f"pair:{key}", pair
+        for user_id, games in guild["games"].items():
+            yield f"games:{user_id}", games
+        for key, flag in guild["flagged"].items():
+            yield f"flag:{key}", flag
+        if guild["alert_channel"] is not None:
+            yield "alert_channel", guild["alert_channel"]
+
+    def _save(self, guild_id, changes):
+        guild = self.guild(guild_id)
+        live_count = len(guild["pairs"]) + len(guild["games"]) + len(guild["flagged"]) + (guild["alert_channel"] is not None)
+        self.log.append(guild_id, changes, live_count, self._records(guild))
+
+    def set_alert_channel(self, guild_id, channel_id):
+        self.guild(guild_id)["alert_channel"] = channel_id
+        self._save(guild_id, [("alert_channel", channel_id)])
+
+    def record(self, guild_id, winner_id, loser_id, transfer, ts=None):
+        # Returns the new flag if this result made the pair suspicious
+        guild = self.guild(guild_id)
+        key, low = HeadToHead.pair_key(winner_id, loser_id)
+        winner_id, loser_id = str(winner_id), str(loser_id)
+
+        pair = guild["pairs"].setdefault(key, {"games": 0, "flips": 0, "last_winner": None, "net_transfer": 0})
+        pair["games"] += 1
+        if pair["last_winner"] not in (None, winner_id):
+            pair["flips"] += 1
+        pair["last_winner"] = winner_id
+        pair["net_transfer"] += transfer if winner_id == low else -transfer  # towards the lower id
+
+        games = guild["games"]
+        games[winner_id] = games.get(winner_id, 0) + 1
+        games[loser_id] = games.get(loser_id, 0) + 1
+
+        changes = [(f"pair:{key}", pair), (f"games:{winner_id}", games[winner_id]), (f"games:{loser_id}", games[loser_id])]
+        flag = self._check(guild, key, pair, games[winner_id], games[loser_id], ts)
+        if flag:
+            guild["flagged"][key] = flag
+            changes.append((f"flag:{key}", flag))
+        self._save(guild_id, changes)
+        return flag
+
+    def _check(self, guild, key, pair, winner_games, loser_games, ts):
+        if key in guild["flagged"] or pair["games"] < SUSPICION_MIN_GAMES:
+            return None
+        # A pair that dominates either player's games qualifies, so an alt that
+        # only ever plays one main is caught even if the main plays others too
+        if pair["games"] < SUSPICION_REPEAT_SHARE * min(winner_games, loser_games):
+            return None
+
+        if pair["flips"] >= SUSPICION_ALTERNATION * (pair["games"] - 1):
+            reason = "Alternating wins"
+        elif abs(pair["net_transfer"]) >= SUSPICION_NET_TRANSFER:
+            reason = "One-sided rating transfer"
+        else:
+            return None
+
+        return {"pair": key, "reason": reason, "flagged_at": int(ts if ts is not None else time.time())}
+
+    def describe(self, guild_id, key):
+        guild = self.guild(guild_id)
+        pair = guild["pairs"][key]
+        low, high = key.split(":")
+        return (
+            f"<@{low}> vs <@{high}>: {pair['games']} games, "
+            f"{pair['flips']} winner flips, {abs(pair['net_transfer'])} elo net to "
+            f"<@{low if pair['net_transfer'] >= 0 else high}> "
+            f"({pair['games'] * 100 // guild['games'][low]}% / {pair['games'] * 100 // guild['games'][high]}% of their games)"
+        )
+
+
+# -----------------------------
+# Seasons (closed seasons are frozen snapshot files, loaded on demand)
+# -----------------------------
+SEASONS_FILE = "seasons.json"
+SEASONS_DIR = "seasons"
+
+def season_path(guild_id, season):
+    return os.path.join(SEASONS_DIR, str(guild_id), f"season_{season}.json")
+
+def save_season_snapshot(guild_id, season, guild_data):
+    # Write then rename, so readers never see a half-written snapshot
+    path = season_path(guild_id, season)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_data(path + ".tmp", guild_data)
+    os.replace(path + ".tmp", path)
+
+@lru_cache(maxsize=8)
+def read_season_snapshot(guild_id, season):
+    # Snapshots never change once written, so caching them is safe. A missing
+    # file raises, and lru_cache doesn't cache exceptions
+    with open(season_path(guild_id, season), "r") as f:
+        return json.load(f)
+
+def load_season_snapshot(guild_id, season):
+    try:
+        return read_season_snapshot(guild_id, season)
+    except FileNotFoundError:
+        return None
+
+SEASON_ARCHIVE_RETRY = 300  # seconds before retrying a failed snapshot
+
+def save_leaderboard():
+    # A guild whose closed season isn't archived yet is saved with its closed
+    # table, so DATA_FILE never drops a season that has no snapshot on disk
+    save_data(DATA_FILE, {**client.leaderboard_data, **{guild_id: closed for guild_id, (_, closed) in client.archiving.items()}})
+
+async def archive_season(guild_id):
+    # Persist in order snapshot -> season counter -> table, so a crash at any
+    # point can neither lose the season nor let the next reset overwrite it.
+    # On failure the new season keeps running and the snapshot is retried later
+    season, closed = client.archiving[guild_id]
+    try:
+        await asyncio.to_thread(save_season_snapshot, guild_id, season, closed)
+        pending = {other: number for other, (number, _) in client.archiving.items() if other != guild_id}
+        save_data(SEASONS_FILE, {**client.seasons, **pending})
+    except Exception as e:
+        print(f"Failed to archive season {season} of guild {guild_id}: {e!r}")
+        client.expiry.schedule(f"season_archive:{guild_id}", time.time() + SEASON_ARCHIVE_RETRY, partial(archive_season, guild_id))
+        return False
+    del client.archiving[guild_id]
+    save_leaderboard()
+    return True
+
+
+# -----------------------------
+# Active challenges (O(1) lookups and updates, persisted through a RecordLog)
+# -----------------------------
+class ActiveChallenges:
+    def __init__(self, directory):
+        self.log = RecordLog(directory)
+        self.guilds = self.log.load()  # guild id -> {"<challenger>:<opponent>": entry}
+        self.busy = {}                 # guild id -> user ids currently in a challenge
+        for guild_id, entries in self.guilds.items():
+            for entry in entries.values():
+                self.busy.setdefault(guild_id, set()).update((entry["challenger"], entry["opponent"]))
+
+    @staticmethod
+    def key(challenger_id, opponent_id):
+        return f"{challenger_id}:{opponent_id}"
+
+    def _save(self, guild_id, key, entry):
+        entries = self.guilds[guild_id]
+        self.log.append(guild_id, [(key, entry)], len(entries), entries.items())
+
+    def entries(self):
+        return [(guild_id, entry) for guild_id, entries in self.guilds.items() for entry in entries.values()]
+
+    def is_busy(self, guild_id, user_id):
+        return user_id in self.busy.get(str(guild_id), ())
+
+    def add(self, guild_id, challenger_id, opponent_id, expires_at):
+        guild_id = str(guild_id)
+        key = self.key(challenger_id, opponent_id)
+        entry = {"challenger": challenger_id, "opponent": opponent_id, "expires_at": expires_at}
+        self.guilds.setdefault(guild_id, {})[key] = entry
+        self.busy.setdefault(guild_id, set()).update((challenger_id, opponent_id))
+        self._save(guild_id, key, entry)
+
+    def set_expiry(self, guild_id, challenger_id, opponent_id, expires_at):
+        guild_id = str(guild_id)
+        key = self.key(challenger_id, opponent_id)
+        entry = self.guilds.get(guild_id, {}).get(key)
+        if entry is None:
+            return False
+        entry["expires_at"] = expires_at
+        self._save(guild_id, key, entry)
+        return True
+
+    def remove(self, guild_id, challenger_id, opponent_id):
+        guild_id = str(guild_id)
+        key = self.key(challenger_id, opponent_id)
+        if self.guilds.get(guild_id, {}).pop(key, None) is None:
+            return
+        self.busy[guild_id].difference_update((challenger_id, opponent_id))
+        self._save(guild_id, key, None)
 
 
 class MyClient(discord.Client):
@@ -63,7 +920,40 @@ class MyClient(discord.Client):
         super().__init__(intents=discord.Intents.default())
         self.tree = app_commands.CommandTree(self)
         self.leaderboard_data = load_data(DATA_FILE)
-        self.active_challenges = load_data(ACTIVE_CHALLENGES_FILE)
+        self.standings = Standings(self.leaderboard_data)
+        self.active_challenges = ActiveChallenges(ACTIVE_CHALLENGES_DIR)
+        self.seasons = load_data(SEASONS_FILE)  # guild id -> current season number
+        self.archiving = {}                     # guild id -> (season, closed table) not on disk yet
+        self.rating_history = RatingHistory(HISTORY_DIR)
+        self.head_to_head = HeadToHead(HEAD_TO_HEAD_DIR)
+        self.integrity = IntegrityMonitor(INTEGRITY_DIR)
+        self.expiry = ExpiryScheduler()
+
+        self.global_opt_in = load_data(GLOBAL_OPT_IN_FILE)  # guild id -> True
+        self.global_leaderboard = GlobalLeaderboard()
+        for guild_id in self.global_opt_in:
+            self.global_leaderboard.add_guild(guild_id, self.leaderboard_data.get(guild_id, {}))
+
+    async def setup_hook(self):
+        self.expiry.start()
+        self.expiry.schedule("encode_metrics", time.time() + ENCODE_METRICS_LOG_INTERVAL, log_encode_metrics)
+
+        # Reap challenges that expired while the bot was offline, and hand the
+        # rest to the scheduler
+        now = time.time()
+        reaped = 0
+        for guild_id, c in self.active_challenges.entries():
+            if c["expires_at"] > now:
+                self.expiry.schedule(
+                    challenge_key(guild_id, c["challenger"], c["opponent"]),
+                    c["expires_at"],
+                    partial(expire_challenge, guild_id, c["challenger"], c["opponent"])
+                )
+            else:
+                self.active_challenges.remove(guild_id, c["challenger"], c["opponent"])
+                reaped += 1
+        if reaped:
+            print(f"Reaped {reaped} expired challenges")
 
     async def on_ready(self):
         print(f"✅ Logged in as {client.user}")
@@ -78,6 +968,80 @@ class MyClient(discord.Client):
 client = MyClient()
 
 
+# -----------------------------
+# Active challenge bookkeeping
+# -----------------------------
+def challenge_key(guild_id, challenger_id, opponent_id):
+    return ("challenge", str(guild_id), challenger_id, opponent_id)
+
+def add_active_challenge(guild_id, challenger_id, opponent_id, timeout, on_expire=None):
+    expires_at = time.time() + timeout
+    client.active_challenges.add(guild_id, challenger_id, opponent_id, expires_at)
+    client.expiry.schedule(
+        challenge_key(guild_id, challenger_id, opponent_id),
+        expires_at,
+        partial(expire_challenge, guild_id, challenger_id, opponent_id, on_expire)
+    )
+
+def set_challenge_expiry(guild_id, challenger_id, opponent_id, timeout, on_expire=None):
+    expires_at = time.time() + timeout
+    if not client.active_challenges.set_expiry(guild_id, challenger_id, opponent_id, expires_at):
+        return  # already finished or expired
+    client.expiry.schedule(
+        challenge_key(guild_id, challenger_id, opponent_id),
+        expires_at,
+        partial(expire_challenge, guild_id, challenger_id, opponent_id, on_expire)
+    )
+
+def remove_active_challenge(guild_id, challenger_id, opponent_id):
+    client.expiry.cancel(challenge_key(guild_id, challenger_id, opponent_id))
+    client.active_challenges.remove(guild_id, challenger_id, opponent_id)
+
+async def expire_challenge(guild_id, challenger_id, opponent_id, on_expire=None):
+    remove_active_challenge(guild_id, challenger_id, opponent_id)
+    if on_expire:
+        await on_expire()
+
+
+# -----------------------------
+# Match results
+# -----------------------------
+def record_match_result(guild_id, winner_id, loser_id):
+    # Returns a flag if the pair now looks like it's trading wins
+    players = [str(winner_id), str(loser_id)]
+    client.standings.before_update(guild_id, players)
+    transfer = update_elo(guild_id, winner_id, loser_id, client.leaderboard_data)
+    client.standings.update(guild_id, players)
+    save_leaderboard()
+
+    winner = get_rating(guild_id, winner_id, client.leaderboard_data)
+    loser = get_rating(guild_id, loser_id, client.leaderboard_data)
+    client.rating_history.append(guild_id, [(winner_id, winner["elo"]), (loser_id, loser["elo"])])
+
+    client.head_to_head.record(guild_id, winner_id, loser_id)
+
+    if str(guild_id) in client.global_opt_in:
+        client.global_leaderboard.update(guild_id, winner_id, winner)
+        client.global_leaderboard.update(guild_id, loser_id, loser)
+
+    return client.integrity.record(guild_id, winner_id, loser_id, transfer)
+
+
+async def alert_suspicious_pair(guild, flag):
+    channel_id = client.integrity.data[str(guild.id)]["alert_channel"]
+    channel = guild.get_channel(channel_id) if channel_id else None
+    if channel is None:
+        return
+    try:
+        await channel.send(embed=discord.Embed(
+            title=f"🚨 Suspicious Pair: {flag['reason']}",
+            description=client.integrity.describe(guild.id, flag["pair"]),
+            color=0xFF8C00
+        ))
+    except:
+        pass
+
+
 # -----------------------------
 # /challenge command (full, with map selection)
 # -----------------------------
@@ -96,26 +1060,15 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
-    if guild_id not in client.active_challenges:
-        client.active_challenges[guild_id] = []
-
     # Check if either user is already in a challenge
-    for ch in client.active_challenges[guild_id]:
-        if challenger.id in (ch["challenger"], ch["opponent"]) or opponent.id in (ch["challenger"], ch["opponent"]):
-            embed = discord.Embed(
-                title="❌ Error",
-                description="One of the users is already in an active challenge!",
-                color=0xFF0000
-            )
-            await interaction.response.send_message(embed=embed, ephemeral=True)
-            return
-
-    # Add to active challenges
-    client.active_challenges[guild_id].append({
-        "challenger": challenger.id,
-        "opponent": opponent.id
-    })
-    save_data(ACTIVE_CHALLENGES_FILE, client.active_challenges)
+    if client.active_challenges.is_busy(guild_id, challenger.id) or client.active_challenges.is_busy(guild_id, opponent.id):
+        embed = discord.Embed(
+            title="❌ Error",
+            description="One of the users is already in an active challenge!",
+            color=0xFF0000
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
 
     # Initial challenge embed
     embed = discord.Embed(
@@ -127,11 +1080,29 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
     # Accept/Decline buttons
     accept_button = discord.ui.Button(label="✅ Accept", style=discord.ButtonStyle.success)
     decline_button = discord.ui.Button(label="❌ Decline", style=discord.ButtonStyle.danger)
-    view = discord.ui.View()
+    view = discord.ui.View(timeout=None)  # expiry is handled by client.expiry
     view.add_item(accept_button)
     view.add_item(decline_button)
 
-    await interaction.response.send_message(embed=embed, view=view)
+    async def on_accept_timeout():
+        view.stop()
+        try:
+            await interaction.edit_original_response(embed=discord.Embed(
+                title="⌛ Challenge Expired",
+                description=f"{opponent.mention} didn't accept the challenge in time.",
+                color=0xFF0000
+            ), view=None)
+        except:
+            pass
+
+    # Add to active challenges (timer included) before sending, and undo it if
+    # the send fails so neither user stays blocked
+    add_active_challenge(guild_id, challenger.id, opponent.id, CHALLENGE_ACCEPT_TIMEOUT, on_accept_timeout)
+    try:
+        await interaction.response.send_message(embed=embed, view=view)
+    except:
+        remove_active_challenge(guild_id, challenger.id, opponent.id)
+        raise
 
     # -----------------------------
     # Accept callback
@@ -144,6 +1115,10 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
             )
             return
 
+        # Swap the accept timer for the winner selection one right away; the
+        # message edit below is attached once the message exists
+        set_challenge_expiry(guild_id, challenger.id, opponent.id, WINNER_SELECT_TIMEOUT)
+
         # Pick a random map
         map_choice = random.choice(["Map A", "Map B", "Map C"])
 
@@ -160,7 +1135,7 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
         )
 
         # Winner selection buttons
-        winner_view = discord.ui.View(timeout=1500)  # 25 min
+        winner_view = discord.ui.View(timeout=None)  # expiry is handled by client.expiry
         challenger_button = discord.ui.Button(label=challenger.display_name, style=discord.ButtonStyle.primary, custom_id="challenger")
         opponent_button = discord.ui.Button(label=opponent.display_name, style=discord.ButtonStyle.success, custom_id="opponent")
 
@@ -181,15 +1156,10 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
                 loser = challenger
 
             # Update ELO
-            update_elo(guild_id, winner.id, loser.id, client.leaderboard_data)
-            save_data(DATA_FILE, client.leaderboard_data)
+            flag = record_match_result(guild_id, winner.id, loser.id)
 
             # Remove from active challenges
-            client.active_challenges[guild_id] = [
-                c for c in client.active_challenges[guild_id]
-                if not (c["challenger"] == challenger.id and c["opponent"] == opponent.id)
-            ]
-            save_data(ACTIVE_CHALLENGES_FILE, client.active_challenges)
+            remove_active_challenge(guild_id, challenger.id, opponent.id)
 
             await winner_interaction.response.edit_message(
                 embed=discord.Embed(
@@ -201,6 +1171,9 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
             )
             winner_view.stop()
 
+            if flag:
+                await alert_suspicious_pair(winner_interaction.guild, flag)
+
         challenger_button.callback = select_winner_callback
         opponent_button.callback = select_winner_callback
         winner_view.add_item(challenger_button)
@@ -213,11 +1186,7 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
 
         # Handle timeout
         async def on_timeout():
-            client.active_challenges[guild_id] = [
-                c for c in client.active_challenges[guild_id]
-                if not (c["challenger"] == challenger.id and c["opponent"] == opponent.id)
-            ]
-            save_data(ACTIVE_CHALLENGES_FILE, client.active_challenges)
+            winner_view.stop()
             try:
                 await winner_msg.edit(embed=discord.Embed(
                     title="⌛ Challenge Timed Out",
@@ -227,7 +1196,7 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
             except:
                 pass
 
-        winner_view.on_timeout = on_timeout
+        set_challenge_expiry(guild_id, challenger.id, opponent.id, WINNER_SELECT_TIMEOUT, on_timeout)
 
     # -----------------------------
     # Decline callback
@@ -240,11 +1209,7 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
             )
             return
 
-        client.active_challenges[guild_id] = [
-            c for c in client.active_challenges[guild_id]
-            if not (c["challenger"] == challenger.id and c["opponent"] == opponent.id)
-        ]
-        save_data(ACTIVE_CHALLENGES_FILE, client.active_challenges)
+        remove_active_challenge(guild_id, challenger.id, opponent.id)
 
         await button_interaction.response.edit_message(
             embed=discord.Embed(
@@ -311,77 +1276,424 @@ async def challenge(interaction: discord.Interaction, opponent: discord.User):
 # /leaderboard command 
 # -----------------------------
 
+def render_leaderboard(entries):
+    # entries: [(rank, username, avatar, stats_text), ...]
+    # Image setup
+    width, height = 600, 60 + 70 * len(entries)
+    image = Image.new("RGBA", (width, height), (30, 30, 30, 255))
+    draw = ImageDraw.Draw(image)
+
+    # Font
+    font = ImageFont.truetype("arial.ttf", 24)
+
+    # Right-aligned column for stats
+    stats_x = 550
+
+    y_offset = 20
+    for rank, username, avatar, stats_text in entries:
+        # Draw ranking number to the left of avatar
+        rank_text = f"{rank}."
+        rank_width = draw.textlength(rank_text, font=font)
+        draw.text((20, int(y_offset + 15)), rank_text, font=font, fill="white")  # vertically centered
+
+        # Paste avatar next to rank number (coordinates must be int)
+        image.paste(avatar, (int(40 + rank_width), int(y_offset)), avatar)
+
+        # Draw username next to avatar
+        draw.text((int(100 + rank_width), int(y_offset)), username, font=font, fill="white")
+
+        # Draw ELO + win/loss (right-aligned)
+        stats_width = draw.textlength(stats_text, font=font)
+        draw.text((int(stats_x - stats_width), int(y_offset)), stats_text, font=font, fill="white")
+
+        y_offset += 70
+
+    return image
+
+
+async def load_avatar(user):
+    # Fetch avatar bytes directly from Discord
+    avatar_bytes = await user.display_avatar.read()
+    return Image.open(BytesIO(avatar_bytes)).convert("RGBA").resize((50, 50))
+
+
+async def send_leaderboard_image(interaction, entries, footer):
+    file = await encode_upload(render_leaderboard(entries), "leaderboard", interaction.guild)
+
+    # Create embed with image
+    embed = discord.Embed(color=0xFFD700)
+    embed.set_image(url=f"attachment://{file.filename}")
+    embed.set_footer(text=footer)
+
+    await interaction.response.send_message(embed=embed, file=file)
+
+
 @client.tree.command(name="leaderboard", description="View the top players by ELO in this server", )
-async def leaderboard(interaction: discord.Interaction):
+@app_commands.describe(
+    scope="This server or all opted-in servers",
+    mode="Global ranking: best rating or total wins",
+    season="Show the final standings of a past season"
+)
+@app_commands.choices(
+    scope=[
+        app_commands.Choice(name="Server", value="server"),
+        app_commands.Choice(name="Global", value="global"),
+    ],
+    mode=[
+        app_commands.Choice(name="Best rating", value="elo"),
+        app_commands.Choice(name="Total wins", value="wins"),
+    ]
+)
+async def leaderboard(interaction: discord.Interaction, scope: app_commands.Choice[str] = None, mode: app_commands.Choice[str] = None, season: int = None):
+    if scope and scope.value == "global":
+        await global_leaderboard(interaction, mode.value if mode else "elo")
+        return
+
     guild_id = str(interaction.guild.id)
-    data = client.leaderboard_data
+    current_season = client.seasons.get(guild_id, 1)
+
+    if season is not None and season != current_season:
+        guild_data = None
+        pending = client.archiving.get(guild_id)
+        if pending and pending[0] == season:
+            guild_data = pending[1]
+        elif 0 < season < current_season:
+            guild_data = await asyncio.to_thread(load_season_snapshot, guild_id, season)
+        if guild_data is None:
+            embed = discord.Embed(
+                title="❌ Unknown Season",
+                description=f"There is no finished season {season} in this server. The current season is {current_season}.",
+                color=0xFF0000
+            )
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+    else:
+        season = current_season
+        guild_data = client.leaderboard_data.get(guild_id)
 
-    if guild_id not in data or not data[guild_id]:
+    if not guild_data:
         embed = discord.Embed(
             title="📉 No matches yet!",
-            description="No matches have been played in this server yet!",
+            description="No matches have been played in this server yet!" if season == current_season
+                        else f"No matches were played in season {season}!",
             color=0xFF0000
         )
         await interaction.response.send_message(embed=embed)
         return
 
-    sorted_players = sorted(data[guild_id].items(), key=lambda x: x[1]["elo"], reverse=True)[:10]
+    sorted_players = sorted(guild_data.items(), key=lambda x: x[1]["elo"], reverse=True)[:10]
 
-    # Image setup
-    width, height = 600, 60 + 70 * len(sorted_players)
-    image = Image.new("RGBA", (width, height), (30, 30, 30, 255))
-    draw = ImageDraw.Draw(image)
-    
-    # Font
-    font = ImageFont.truetype("arial.ttf", 24)
-    
-    # Right-aligned column for stats
-    stats_x = 550
-
-    y_offset = 20
+    entries = []
     for i, (user_id, stats) in enumerate(sorted_players, start=1):
         # Fetch member
         try:
             member = await interaction.guild.fetch_member(int(user_id))
             username = member.display_name
+            avatar = await load_avatar(member)
+        except:
+            username = f"User {user_id}"
+            avatar = Image.new("RGBA", (50, 50), (100, 100, 100, 255))  # gray placeholder
+
+        entries.append((i, username, avatar, f"{stats['elo']} ({stats['wins']}/{stats['losses']})"))
+
+    await send_leaderboard_image(interaction, entries, f"Season {season} • Total players: {len(sorted_players)}")
+
 
-            # Fetch avatar bytes directly from Discord
-            avatar_bytes = await member.display_avatar.read()
-            avatar = Image.open(BytesIO(avatar_bytes)).convert("RGBA").resize((50, 50))
+async def global_leaderboard(interaction, mode):
+    board = client.global_leaderboard
+    index = board.indexes[mode]
+
+    if not index.scores:
+        embed = discord.Embed(
+            title="📉 No global standings yet!",
+            description="No matches have been played in any opted-in server yet!",
+            color=0xFF0000
+        )
+        await interaction.response.send_message(embed=embed)
+        return
+
+    entries = []
+    for i, (user_id, _) in enumerate(index.top(10), start=1):
+        best, wins, losses = board.totals(user_id)
+        try:
+            user = await client.fetch_user(int(user_id))
+            username = user.display_name
+            avatar = await load_avatar(user)
         except:
             username = f"User {user_id}"
             avatar = Image.new("RGBA", (50, 50), (100, 100, 100, 255))  # gray placeholder
 
-        # Draw ranking number to the left of avatar
-        rank_text = f"{i}."
-        rank_width = draw.textlength(rank_text, font=font)
-        draw.text((20, int(y_offset + 15)), rank_text, font=font, fill="white")  # vertically centered
+        entries.append((i, username, avatar, f"{best} ({wins}/{losses})"))
 
-        # Paste avatar next to rank number (coordinates must be int)
-        image.paste(avatar, (int(40 + rank_width), int(y_offset)), avatar)
+    footer = f"Global • Total players: {len(index.scores)}"
+    rank = index.rank(str(interaction.user.id))
+    if rank:
+        footer += f" • Your rank: #{rank}"
+    await send_leaderboard_image(interaction, entries, footer)
 
-        # Draw username next to avatar
-        draw.text((int(100 + rank_width), int(y_offset)), username, font=font, fill="white")
 
-        # Draw ELO + win/loss (right-aligned)
-        stats_text = f"{stats['elo']} ({stats['wins']}/{stats['losses']})"
-        stats_width = draw.textlength(stats_text, font=font)
-        draw.text((int(stats_x - stats_width), int(y_offset)), stats_text, font=font, fill="white")
 
-        y_offset += 70
+# -----------------------------
+# /global_leaderboard command (opt in/out)
+# -----------------------------
+@client.tree.command(name="global_leaderboard", description="Include this server in the global leaderboard (admin only)")
+@app_commands.describe(enabled="Whether this server's players count towards the global leaderboard")
+async def global_leaderboard_opt_in(interaction: discord.Interaction, enabled: bool):
+    guild_id = str(interaction.guild.id)
+    if not interaction.user.guild_permissions.administrator:
+        embed = Embed(title="❌ Permission Denied", description="Only administrators can change this setting.", color=0xFF0000)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    guild_data = client.leaderboard_data.get(guild_id, {})
+    if enabled and guild_id not in client.global_opt_in:
+        client.global_opt_in[guild_id] = True
+        client.global_leaderboard.add_guild(guild_id, guild_data)
+    elif not enabled and guild_id in client.global_opt_in:
+        del client.global_opt_in[guild_id]
+        client.global_leaderboard.remove_guild(guild_id, guild_data)
+    save_data(GLOBAL_OPT_IN_FILE, client.global_opt_in)
+
+    description = "This server now counts towards the global leaderboard!" if enabled else "This server no longer counts towards the global leaderboard."
+    embed = Embed(title="🌍 Global Leaderboard", description=description, color=0x00FF00)
+    await interaction.response.send_message(embed=embed)
+
+
+
+
+# -----------------------------
+# /h2h and /rivals commands
+# -----------------------------
+@client.tree.command(name="h2h", description="Show the head-to-head record between two players")
+@app_commands.describe(player_a="First player", player_b="Second player")
+async def h2h(interaction: discord.Interaction, player_a: discord.User, player_b: discord.User):
+    guild_id = str(interaction.guild.id)
+    record = client.head_to_head.get(guild_id, player_a.id, player_b.id) if player_a != player_b else None
+
+    if record is None:
+        embed = discord.Embed(
+            title="📉 No matches yet!",
+            description=f"{player_a.mention} and {player_b.mention} haven't played each other in this server yet!",
+            color=0xFF0000
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    wins_a, wins_b, last_played = record
+    embed = discord.Embed(
+        title="⚔️ Head to Head",
+        description=f"{player_a.mention} vs {player_b.mention}",
+        color=0x00BFFF
+    )
+    embed.add_field(name=player_a.display_name, value=str(wins_a), inline=True)
+    embed.add_field(name=player_b.display_name, value=str(wins_b), inline=True)
+    embed.add_field(name="Last played", value=f"<t:{last_played}:R>", inline=False)
+    await interaction.response.send_message(embed=embed)
 
-    # Convert image to BytesIO
-    with BytesIO() as image_binary:
-        image.save(image_binary, "PNG")
-        image_binary.seek(0)
 
-        # Create embed with image
-        file = discord.File(fp=image_binary, filename="leaderboard.png")
-        embed = discord.Embed(color=0xFFD700)
-        embed.set_image(url="attachment://leaderboard.png")
-        embed.set_footer(text=f"Total players: {len(sorted_players)}")
+@client.tree.command(name="rivals", description="Show a player's most-played opponents")
+@app_commands.describe(user="The player to show (defaults to you)")
+async def rivals(interaction: discord.Interaction, user: discord.User = None):
+    user = user or interaction.user
+    guild_id = str(interaction.guild.id)
+    top_rivals = client.head_to_head.rivals(guild_id, user.id)
+
+    if not top_rivals:
+        embed = discord.Embed(
+            title="📉 No matches yet!",
+            description=f"{user.mention} hasn't played any matches in this server yet!",
+            color=0xFF0000
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
 
-        await interaction.response.send_message(embed=embed, file=file)
+    lines = [
+        f"{i}. <@{opponent}>: {wins}/{losses} (last <t:{last_played}:R>)"
+        for i, (opponent, wins, losses, last_played) in enumerate(top_rivals, start=1)
+    ]
+    embed = discord.Embed(title=f"🔥 {user.display_name}'s Rivals", description="\n".join(lines), color=0xFFD700)
+    embed.set_footer(text="W/L from their side")
+    await interaction.response.send_message(embed=embed)
+
+
+
+
+# -----------------------------
+# /integrity_channel and /suspicious commands (admin only)
+# -----------------------------
+@client.tree.command(name="integrity_channel", description="Set the channel for suspicious match alerts (admin only)")
+@app_commands.describe(channel="Where to post alerts about possible win trading")
+async def integrity_channel(interaction: discord.Interaction, channel: discord.TextChannel):
+    if not interaction.user.guild_permissions.administrator:
+        embed = Embed(title="❌ Permission Denied", description="Only administrators can change this setting.", color=0xFF0000)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    client.integrity.set_alert_channel(interaction.guild.id, channel.id)
+
+    embed = Embed(title="🚨 Alerts Channel Set", description=f"Suspicious pairs will be reported in {channel.mention}.", color=0x00FF00)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+@client.tree.command(name="suspicious", description="List pairs flagged for possible win trading (admin only)")
+async def suspicious(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        embed = Embed(title="❌ Permission Denied", description="Only administrators can view flagged pairs.", color=0xFF0000)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    flagged = client.integrity.guild(interaction.guild.id)["flagged"]
+    if not flagged:
+        embed = Embed(title="✅ Nothing Flagged", description="No suspicious pairs in this server.", color=0x00FF00)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    # Newest first, trimmed to fit in one embed
+    lines = []
+    for flag in sorted(flagged.values(), key=lambda f: f["flagged_at"], reverse=True):
+        line = f"**{flag['reason']}** (<t:{flag['flagged_at']}:R>)\n{client.integrity.describe(interaction.guild.id, flag['pair'])}"
+        if sum(len(l) + 2 for l in lines) + len(line) > 4000:
+            break
+        lines.append(line)
+
+    embed = Embed(title="🚨 Suspicious Pairs", description="\n\n".join(lines), color=0xFF8C00)
+    embed.set_footer(text=f"{len(flagged)} flagged pairs")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+
+
+# -----------------------------
+# /stats command
+# -----------------------------
+@client.tree.command(name="stats", description="Show a player's rating over time")
+@app_commands.describe(user="The player to show (defaults to you)")
+async def stats(interaction: discord.Interaction, user: discord.User = None):
+    user = user or interaction.user
+    guild_id = str(interaction.guild.id)
+    player = client.leaderboard_data.get(guild_id, {}).get(str(user.id))
+    timestamps, elos = await asyncio.to_thread(client.rating_history.get, guild_id, user.id)
+
+    if player is None or not timestamps:
+        embed = discord.Embed(
+            title="📉 No matches yet!",
+            description=f"{user.mention} hasn't played any matches in this server yet!",
+            color=0xFF0000
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    await interaction.response.defer()
+
+    # Render off the event loop
+    chart = await asyncio.to_thread(render_rating_chart, user.display_name, timestamps, elos, dict(player))
+
+    file = await encode_upload(chart, "stats", interaction.guild)
+    embed = discord.Embed(title=f"📈 {user.display_name}", color=0xFFD700)
+    embed.set_image(url=f"attachment://{file.filename}")
+    embed.set_footer(text=f"{len(elos)} rating points")
+    await interaction.followup.send(embed=embed, file=file)
+
+
+
+
+# -----------------------------
+# /export command (streams gzip parts, one row at a time)
+# -----------------------------
+EXPORT_HEADERS = {"csv": "rank,user_id,elo,wins,losses\n", "ndjson": ""}
+EXPORT_FLUSH_MARGIN = 512 * 1024  # room for whatever zlib still buffers
+EXPORT_BATCH_SIZE = 1000          # rows copied per event loop step
+
+def iter_standings(players, file_format, start=1):
+    for rank, (user_id, elo, wins, losses) in enumerate(players, start=start):
+        if file_format == "csv":
+            yield f"{rank},{user_id},{elo},{wins},{losses}\n"
+        else:
+            yield json.dumps({"rank": rank, "user_id": user_id, "elo": elo, "wins": wins, "losses": losses}) + "\n"
+
+class ExportWriter:
+    # Each part is a standalone .gz file on disk with its own header, so memory
+    # stays flat and any part can be opened on its own. Batches are written in
+    # order from a worker thread, one at a time
+    def __init__(self, file_format, max_bytes):
+        self.file_format = file_format
+        self.max_bytes = max_bytes
+        self.header = EXPORT_HEADERS[file_format].encode()
+        self.parts = []
+        self.part = self.compressor = None
+        self.written = 0
+        self.rows = 0
+
+    def _close_part(self):
+        self.part.write(self.compressor.flush())
+        self.part.seek(0)
+        self.parts.append(self.part)
+
+    def write(self, players):
+        for line in iter_standings(players, self.file_format, start=self.rows + 1):
+            if self.part is None or self.written > self.max_bytes - EXPORT_FLUSH_MARGIN:
+                if self.part is not None:
+                    self._close_part()
+                self.part = tempfile.TemporaryFile()
+                self.compressor = zlib.compressobj(9, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+                self.written = self.part.write(self.compressor.compress(self.header))
+            self.written += self.part.write(self.compressor.compress(line.encode()))
+        self.rows += len(players)
+
+    def close(self):
+        if self.part is not None:
+            self._close_part()
+            self.part = None
+        return self.parts
+
+
+@client.tree.command(name="export", description="Export this server's full standings (admin only)")
+@app_commands.describe(file_format="File format for the export")
+@app_commands.rename(file_format="format")
+@app_commands.choices(file_format=[
+    app_commands.Choice(name="CSV", value="csv"),
+    app_commands.Choice(name="NDJSON", value="ndjson"),
+])
+async def export(interaction: discord.Interaction, file_format: app_commands.Choice[str] = None):
+    guild_id = str(interaction.guild.id)
+    if not interaction.user.guild_permissions.administrator:
+        embed = Embed(title="❌ Permission Denied", description="Only administrators can export the leaderboard.", color=0xFF0000)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    guild_data = client.leaderboard_data.get(guild_id)
+    if not guild_data:
+        embed = Embed(title="📉 No matches yet!", description="No matches have been played in this server yet!", color=0xFF0000)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    file_format = file_format.value if file_format else "csv"
+    await interaction.response.defer(ephemeral=True)
+
+    # Rank order comes from the maintained elo index a batch at a time, copied
+    # to plain values on the loop (update_elo edits the stats dicts in place);
+    # compressing runs in a worker
+    writer = ExportWriter(file_format, interaction.guild.filesize_limit)
+    batches = client.standings.walk(guild_id, EXPORT_BATCH_SIZE)
+    try:
+        for players in batches:
+            await asyncio.to_thread(writer.write, players)
+    finally:
+        batches.close()
+    parts = writer.close()
+
+    try:
+        # The upload limit applies to the whole message, so one part per message
+        for i, part in enumerate(parts, start=1):
+            filename = f"standings_{guild_id}_{i}.{file_format}.gz" if len(parts) > 1 else f"standings_{guild_id}.{file_format}.gz"
+            await interaction.followup.send(
+                content=f"📦 Standings for {writer.rows} players" if i == 1 else None,
+                file=discord.File(fp=part, filename=filename),
+                ephemeral=True
+            )
+    finally:
+        for part in parts:
+            part.close()
 
 
 
@@ -389,7 +1701,7 @@ async def leaderboard(interaction: discord.Interaction):
 # -----------------------------
 # /reset_leaderboard command
 # -----------------------------
-@client.tree.command(name="reset_leaderboard", description="Reset this server's leaderboard (admin only)")
+@client.tree.command(name="reset_leaderboard", description="End the current season and start a new one (admin only)")
 async def reset_leaderboard(interaction: discord.Interaction):
     guild_id = str(interaction.guild.id)
     if not interaction.user.guild_permissions.administrator:
@@ -397,11 +1709,30 @@ async def reset_leaderboard(interaction: discord.Interaction):
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
+    if guild_id in client.archiving:
+        embed = Embed(title="⏳ Reset Pending", description=f"Season {client.archiving[guild_id][0]} is still being archived. Try again later.", color=0xFF8C00)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    await interaction.response.defer()
+
+    # Swap in an empty table; nothing references the old one afterwards, so it
+    # is the frozen snapshot of the closed season without any copying
+    season = client.seasons.get(guild_id, 1)
+    closed = client.leaderboard_data.get(guild_id, {})
     client.leaderboard_data[guild_id] = {}
-    save_data(DATA_FILE, client.leaderboard_data)
+    client.standings.reset(guild_id)
+    client.seasons[guild_id] = season + 1
+    if guild_id in client.global_opt_in:
+        client.global_leaderboard.remove_guild(guild_id, closed)
 
-    embed = Embed(title="✅ Leaderboard Reset", description="The leaderboard has been reset for this server!", color=0x00FF00)
-    await interaction.response.send_message(embed=embed)
+    client.archiving[guild_id] = (season, closed)
+    description = (f"Season {season} is over and season {season + 1} has started!\n"
+                   f"View the final standings with `/leaderboard season:{season}`.")
+    if not await archive_season(guild_id):
+        description += "\nThe final standings couldn't be saved yet and will be retried shortly."
+
+    embed = Embed(title="✅ Leaderboard Reset", description=description, color=0x00FF00)
+    await interaction.followup.send(embed=embed)
 
 
 
@@ -677,12 +2008,14 @@ async def start_tournament(channel, players, creator):
         "players": players,
         "winners": [],
         "winners_map": {},  # match_id -> winner
-        "player_names": [p.display_name for p in players]
+        "player_names": [p.display_name for p in players],
+        "pending_matches": {},  # expiry key -> (view, message)
+        "cancelled": False
     }
 
     # Send initial full bracket
-    bracket_img = generate_full_bracket(state["player_names"], state["winners_map"])
-    await channel.send(file=discord.File(fp=bracket_img, filename="bracket.png"))
+    bracket_img = await asyncio.to_thread(generate_full_bracket, state["player_names"], state["winners_map"])
+    await channel.send(file=await encode_upload(bracket_img, "bracket", channel.guild, palette=True))
 
     await run_tournament_round(channel, state, creator)
 
@@ -730,9 +2063,45 @@ def generate_full_bracket(players, winners_map=None):
             curr_round.append(node_id)
         prev_round = curr_round
 
-    img_bytes = BytesIO(dot.pipe())
-    img_bytes.seek(0)
-    return img_bytes
+    return dot.pipe()
+
+
+# -----------------------------
+# Tournament match expiry
+# -----------------------------
+async def expire_tournament_match(channel, state, key):
+    view, message = state["pending_matches"].pop(key)
+    view.stop()
+    try:
+        if message is not None:  # None while the match message is still being sent
+            await message.edit(embed=discord.Embed(
+                title="⌛ Match Timed Out",
+                description="No winner was declared in time.",
+                color=0xFF0000
+            ), view=None)
+    except:
+        pass
+
+    if state["cancelled"]:
+        return
+    state["cancelled"] = True
+
+    # One undecided match stalls the whole bracket, so close the rest too
+    for other_key, (other_view, other_message) in list(state["pending_matches"].items()):
+        client.expiry.cancel(other_key)
+        other_view.stop()
+        try:
+            if other_message is not None:
+                await other_message.edit(view=None)
+        except:
+            pass
+    state["pending_matches"].clear()
+
+    await channel.send(embed=discord.Embed(
+        title="🚫 Tournament Cancelled",
+        description="A match wasn't decided in time, so the tournament was cancelled.",
+        color=0xFF0000
+    ))
 
 
 # -----------------------------
@@ -769,11 +2138,18 @@ async def run_tournament_round(channel, state, creator):
 
         # Compute the correct node ID for the winner in the bracket
         next_round_node_id = f"R{round_num}_M{m_idx}"
+        match_key = ("match", id(state), round_num, m_idx)
 
-        async def winner_callback(interaction: discord.Interaction, winner, loser, match_node_id=next_round_node_id):
+        async def winner_callback(interaction: discord.Interaction, winner, loser, match_node_id=next_round_node_id, match_key=match_key):
             if interaction.user.id not in (winner.id, loser.id, creator.id):
                 await interaction.response.send_message("❌ Not authorized!", ephemeral=True)
                 return
+            if state["cancelled"] or match_key not in state["pending_matches"]:
+                await interaction.response.send_message("❌ This match is no longer active!", ephemeral=True)
+                return
+
+            client.expiry.cancel(match_key)
+            del state["pending_matches"][match_key]
 
             state["winners"].append(winner)
             state["winners_map"][match_node_id] = winner.display_name
@@ -791,8 +2167,8 @@ async def run_tournament_round(channel, state, creator):
 
             if state["matches_remaining"] == 0:
                 # Send updated bracket
-                bracket_img = generate_full_bracket(state["player_names"], state["winners_map"])
-                await channel.send(file=discord.File(fp=bracket_img, filename="bracket.png"))
+                bracket_img = await asyncio.to_thread(generate_full_bracket, state["player_names"], state["winners_map"])
+                await channel.send(file=await encode_upload(bracket_img, "bracket", channel.guild, palette=True))
 
                 if len(state["winners"]) == 1:
                     await channel.send(embed=discord.Embed(
@@ -816,7 +2192,23 @@ async def run_tournament_round(channel, state, creator):
             description=f"{player1.mention} vs {player2.mention}\nParticipants or {creator.display_name} can declare the winner.",
             color=0x00BFFF
         )
-        await channel.send(embed=embed, view=view)
+
+        # Register before sending so an early click finds the match; the
+        # message is attached once it exists
+        state["pending_matches"][match_key] = (view, None)
+        client.expiry.schedule(
+            match_key,
+            time.time() + TOURNAMENT_MATCH_TIMEOUT,
+            partial(expire_tournament_match, channel, state, match_key)
+        )
+        try:
+            message = await channel.send(embed=embed, view=view)
+        except:
+            client.expiry.cancel(match_key)
+            state["pending_matches"].pop(match_key, None)
+            raise
+        if match_key in state["pending_matches"]:
+            state["pending_matches"][match_key] = (view, message)
 
 
 
@@ -834,8 +2226,15 @@ async def help(interaction: discord.Interaction):
         color=0x00FFFF
     )
     embed.add_field(name="/challenge", value="1v1 mode for the leaderboard", inline=False)
-    embed.add_field(name="/leaderboard", value="Show leaderboard", inline=False)
-    embed.add_field(name="/reset_leaderboard", value="Resets leaderboard", inline=False)
+    embed.add_field(name="/leaderboard", value="Show leaderboard (scope: global for all opted-in servers)", inline=False)
+    embed.add_field(name="/global_leaderboard", value="Opt this server in or out of the global leaderboard (admin)", inline=False)
+    embed.add_field(name="/stats", value="Show a player's rating over time and streaks", inline=False)
+    embed.add_field(name="/h2h", value="Head-to-head record between two players", inline=False)
+    embed.add_field(name="/rivals", value="A player's most-played opponents", inline=False)
+    embed.add_field(name="/export", value="Download the full standings as CSV or NDJSON (admin)", inline=False)
+    embed.add_field(name="/suspicious", value="List pairs flagged for possible win trading (admin)", inline=False)
+    embed.add_field(name="/integrity_channel", value="Set where win-trading alerts are posted (admin)", inline=False)
+    embed.add_field(name="/reset_leaderboard", value="Ends the season and starts a fresh leaderboard", inline=False)
     embed.add_field(name="/tournament", value="Forms a tournament bracket for 4, 8, or 16 players", inline=False)
     embed.set_footer(text="Use these commands to compete and track scores!")
     